@@ -1,6 +1,8 @@
 import os
 import sys
 import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 
 # ==========================================
@@ -25,8 +27,11 @@ DIR_DATA = os.path.join(RUN_DIR, "step_result_csvs")
 DIR_REPORTS = os.path.join(RUN_DIR, "Progress_Report")
 DIR_PDFS = os.path.join(RUN_DIR, "Downloaded_PDFs")
 
+# Shared by every run (outside RUN_DIR) so reruns can reuse earlier AI results
+DIR_CACHE = "Pipeline_Cache"
+
 # Create the folders
-for d in [DIR_DATA, DIR_REPORTS, DIR_PDFS]:
+for d in [DIR_DATA, DIR_REPORTS, DIR_PDFS, DIR_CACHE]:
     os.makedirs(d, exist_ok=True)
 
 # Master Log File
@@ -38,43 +43,93 @@ def log_and_print(msg):
     with open(LOG_FILE, "a", encoding="utf-8") as f:
         f.write(msg + "\n")
 
-def run_step(step_name, script_name, args_list):
-    """Runs a python script, captures its output, and halts if it fails."""
-    log_and_print(f"\n{'='*50}\n🚀 STARTING {step_name}\n{'='*50}")
-    
+def launch_step(script_name, args_list):
+    """Starts a python script with its stdout+stderr piped back to us."""
     cmd = [sys.executable, script_name] + args_list
     
     # --- NEW: Force Windows to use UTF-8 so emojis don't crash the script ---
     custom_env = os.environ.copy()
     custom_env["PYTHONIOENCODING"] = "utf-8"
     
-    # Run process and capture output line by line
-    process = subprocess.Popen(
+    # Larger OS pipe (Python 3.10+) so a chatty step rarely blocks waiting on us
+    pipe_kwargs = {"pipesize": 1024 * 1024} if sys.version_info >= (3, 10) else {}
+    
+    return subprocess.Popen(
         cmd, 
         stdout=subprocess.PIPE, 
         stderr=subprocess.STDOUT, 
         text=True, 
         encoding='utf-8', 
         errors='replace',
-        env=custom_env # Applies the UTF-8 rule
+        bufsize=-1,
+        env=custom_env, # Applies the UTF-8 rule
+        **pipe_kwargs
     )
+
+def halt_pipeline(step_name, returncode):
+    log_and_print(f"\n❌ FATAL ERROR: {step_name} failed with exit code {returncode}.")
+    log_and_print("🛑 HALTING PIPELINE to prevent data corruption. Check the log and report files for details.")
+    sys.exit(1)
+
+def run_step(step_name, script_name, args_list):
+    """Runs a python script, captures its output, and halts if it fails."""
+    log_and_print(f"\n{'='*50}\n🚀 STARTING {step_name}\n{'='*50}")
+    
+    # Run process and capture output line by line
+    process = launch_step(script_name, args_list)
     
-    for line in process.stdout:
-        clean_line = line.strip()
-        print(clean_line)
-        with open(LOG_FILE, "a", encoding="utf-8") as f:
-            f.write(clean_line + "\n")
+    # Open the log once for the whole step (line-buffered) instead of reopening it per line
+    with open(LOG_FILE, "a", encoding="utf-8", buffering=1) as log_file:
+        for line in process.stdout:
+            print(line, end="")
+            log_file.write(line)
             
     process.wait()
     
     # Halt completely if the step crashed
     if process.returncode != 0:
-        log_and_print(f"\n❌ FATAL ERROR: {step_name} failed with exit code {process.returncode}.")
-        log_and_print("🛑 HALTING PIPELINE to prevent data corruption. Check the log and report files for details.")
-        sys.exit(1)
+        halt_pipeline(step_name, process.returncode)
     
     log_and_print(f"✅ {step_name} COMPLETED SUCCESSFULLY.")
 
+def run_steps_together(steps):
+    """
+    Runs several (step_name, script_name, args_list) steps at the same time, for steps that
+    stream work to each other. Output lines are tagged with their step. If any step fails,
+    the others are stopped and the pipeline halts.
+    """
+    names = " + ".join(step_name for step_name, _, _ in steps)
+    log_and_print(f"\n{'='*50}\n🚀 STARTING {names}\n{'='*50}")
+    
+    log_lock = threading.Lock()
+    processes = [launch_step(script_name, args_list) for _, script_name, args_list in steps]
+    failed = None
+    
+    with open(LOG_FILE, "a", encoding="utf-8", buffering=1) as log_file:
+        def relay_output(tag, process):
+            for line in process.stdout:
+                with log_lock:
+                    print(f"[{tag}] {line}", end="")
+                    log_file.write(f"[{tag}] {line}")
+            return process.wait()
+        
+        with ThreadPoolExecutor(max_workers=len(steps)) as executor:
+            futures = {
+                executor.submit(relay_output, step_name.split(" (")[0], process): step_name
+                for (step_name, _, _), process in zip(steps, processes)
+            }
+            for future in as_completed(futures):
+                if future.result() != 0 and failed is None:
+                    failed = (futures[future], future.result())
+                    # A downstream step would wait forever on a crashed producer
+                    for process in processes:
+                        if process.poll() is None: process.terminate()
+    
+    if failed:
+        halt_pipeline(*failed)
+    
+    log_and_print(f"✅ {names} COMPLETED SUCCESSFULLY.")
+
 # ==========================================
 #        PIPELINE EXECUTION
 # ==========================================
@@ -104,15 +159,18 @@ if __name__ == "__main__":
         "--report", rep_1
     ])
 
-# STEP 2
-    run_step("STEP 2 (Relevancy Filter)", "step2_relevancy_filter.py", [
-        "--in_csv", csv_1, "--out_csv", csv_2, "--report", rep_2, "--api", API_KEY
-    ])
-
-    # STEP 3
-    run_step("STEP 3 (Download PDFs)", "step3_download_pdfs.py", [
-        "--in_csv", csv_2, "--out_csv", csv_3, "--report", rep_3, 
-        "--pdf_dir", DIR_PDFS, "--email", EMAIL
+    # STEPS 2 + 3 (Overlapped: Step 3 downloads each batch Step 2 accepts while Step 2 keeps screening)
+    stream_2 = os.path.join(DIR_DATA, "2_accepted_stream")
+    os.makedirs(stream_2, exist_ok=True)
+    run_steps_together([
+        ("STEP 2 (Relevancy Filter)", "step2_relevancy_filter.py", [
+            "--in_csv", csv_1, "--out_csv", csv_2, "--report", rep_2, "--api", API_KEY,
+            "--cache_dir", DIR_CACHE, "--stream_dir", stream_2
+        ]),
+        ("STEP 3 (Download PDFs)", "step3_download_pdfs.py", [
+            "--in_csv", csv_2, "--out_csv", csv_3, "--report", rep_3, 
+            "--pdf_dir", DIR_PDFS, "--email", EMAIL, "--follow", stream_2
+        ]),
     ])
 
     # STEP 4
@@ -123,7 +181,7 @@ if __name__ == "__main__":
     # STEP 5
     run_step("STEP 5 (Analysis)", "step5_analysis.py", [
         "--in_csv", csv_4, "--out_csv", csv_5, "--report", rep_5, 
-        "--pdf_dir", DIR_PDFS, "--api", API_KEY
+        "--pdf_dir", DIR_PDFS, "--api", API_KEY, "--cache_dir", DIR_CACHE
     ])
 
 
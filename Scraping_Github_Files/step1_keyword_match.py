@@ -1,8 +1,14 @@
 import pyalex
 from pyalex import Works
 import pandas as pd
+import numpy as np
 import time
 import argparse
+import csv
+import queue
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
 # --- NEW: ARGPARSE SETUP ---
 parser = argparse.ArgumentParser()
@@ -15,102 +21,202 @@ args = parser.parse_args()
 
 # --- CONFIGURATION (UPDATED TO USE ARGS) ---
 pyalex.config.email = args.email
+pyalex.config.user_agent = f"Web-Scraping-Pipeline (mailto:{args.email})" # Stays in the polite pool
+pyalex.config.max_retries = 3
 
 # The 3-Pronged Query
 SEARCH_QUERY = args.query
 MAX_RESULTS = args.max 
+PER_PAGE = 200 # OpenAlex maximum page size
+MAX_CONCURRENT_QUERIES = 10 # OpenAlex allows ~10 requests per second
+QUEUED_PAGES = 2 # Pages a sub-query may fetch ahead of the writer before it blocks
+
+FIELDNAMES = ["ID", "Generated_Citation", "Title", "Year", "DOI", "Abstract", "PDF_Link", "Source"]
 
 def format_citation(paper):
     """
     Constructs an APA-style citation. This string is the PERMANENT ID.
     """
+    auths = paper.get('authorships') or ()
+    n = len(auths)
     try:
-        authorships = paper.get('authorships', [])
-        if not authorships:
+        # Only the first name is needed for "et al.", so the full list is built only for 2-3 authors
+        if n == 0:
             auth_str = "Unknown Author"
+        elif n > 3:
+            auth_str = f"{auths[0]['author'].get('display_name', 'Unknown')} et al."
         else:
-            names = [a.get('author', {}).get('display_name', 'Unknown') for a in authorships]
-            if len(names) > 3:
-                auth_str = f"{names[0]} et al."
-            elif len(names) > 1:
-                auth_str = " & ".join(names)
-            else:
-                auth_str = names[0]
-        
-        year = paper.get('publication_year', 'n.d.')
-        title = paper.get('title', 'Untitled')
+            auth_str = " & ".join(a['author'].get('display_name', 'Unknown') for a in auths)
         
-        source = paper.get('primary_location', {}).get('source', {})
+        source = (paper.get('primary_location') or {}).get('source')
         journal = source.get('display_name', '') if source else ""
-        
-        # Format: Smith, J. (2020). The Title. Journal.
-        citation = f"{auth_str} ({year}). {title}."
-        if journal:
-            citation += f" {journal}."
-            
-        return citation
-    except Exception:
+    except (KeyError, TypeError, AttributeError):
         return f"Unknown Paper ({paper.get('id')})"
+    
+    year = paper.get('publication_year', 'n.d.')
+    title = paper.get('title', 'Untitled')
+    
+    # Format: Smith, J. (2020). The Title. Journal.
+    citation = f"{auth_str} ({year}). {title}."
+    if journal:
+        citation += f" {journal}."
+        
+    return citation
 
 def reconstruct_abstract(inverted_index):
     if not inverted_index: return None
-    word_list = []
-    for word, positions in inverted_index.items():
-        for pos in positions:
-            word_list.append((pos, word))
-    word_list.sort()
-    return " ".join([w[1] for w in word_list])
+    # Flatten {word: [positions]} into parallel arrays, then order the words by position in C
+    positions = np.fromiter((pos for poses in inverted_index.values() for pos in poses), dtype=np.int32)
+    words = np.array([word for word, poses in inverted_index.items() for _ in poses], dtype=object)
+    return " ".join(words[np.argsort(positions, kind='stable')])
+
+def _closing_paren(query):
+    """Returns the index of the ')' that closes the '(' at position 0, or -1 if it never closes."""
+    depth, in_quotes = 0, False
+    for i, c in enumerate(query):
+        if c == '"':
+            in_quotes = not in_quotes
+        elif not in_quotes and c == '(':
+            depth += 1
+        elif not in_quotes and c == ')':
+            depth -= 1
+            if depth == 0: return i
+    return -1
+
+def split_top_level_or(query):
+    """
+    Splits a boolean query on its top-level OR operators.
+    '(A AND B) OR (C AND D)' -> ['(A AND B)', '(C AND D)']. ORs inside parentheses or quotes are left alone.
+    """
+    query = query.strip()
+    while query.startswith('(') and _closing_paren(query) == len(query) - 1:
+        query = query[1:-1].strip()
+    
+    parts, depth, in_quotes, start, i = [], 0, False, 0, 0
+    while i < len(query):
+        c = query[i]
+        if c == '"':
+            in_quotes = not in_quotes
+        elif not in_quotes and c == '(':
+            depth += 1
+        elif not in_quotes and c == ')':
+            depth -= 1
+        elif not in_quotes and depth == 0 and query.startswith(" OR ", i):
+            parts.append(query[start:i].strip())
+            i = start = i + 4
+            continue
+        i += 1
+    parts.append(query[start:].strip())
+    return [p for p in parts if p]
+
+def fetch_query(query, page_queue, stop_event, fetch_sem):
+    """Pushes pages of up to MAX_RESULTS papers for one sub-query onto page_queue, then a None sentinel."""
+    try:
+        pager = iter(Works().search(query).filter(has_abstract=True).paginate(
+            method="cursor", per_page=min(PER_PAGE, MAX_RESULTS), n_max=MAX_RESULTS
+        ))
+        fetched = 0
+        while not stop_event.is_set():
+            # Only the request itself holds a slot, so a sub-query blocked on its full queue never starves the others
+            with fetch_sem:
+                page = next(pager, None)
+            if page is None or stop_event.is_set(): break
+            # The last page can run past MAX_RESULTS, so only take what is still needed
+            page = page[:MAX_RESULTS - fetched]
+            fetched += len(page)
+            page_queue.put(page)
+            print(f"   [{query[:40]}] Fetched {fetched} papers...")
+    finally:
+        page_queue.put(None)
+
+def build_item(paper):
+    abstract = reconstruct_abstract(paper.get('abstract_inverted_index'))
+    pdf_link = paper.get('open_access', {}).get('oa_url') if paper.get('open_access') else None
+    
+    full_citation = format_citation(paper)
+    
+    return {
+        "ID": paper.get('id'),
+        "Generated_Citation": full_citation, 
+        "Title": paper.get('title'),
+        "Year": paper.get('publication_year'),
+        "DOI": paper.get('doi'),
+        "Abstract": abstract,
+        "PDF_Link": pdf_link,
+        "Source": "OpenAlex"
+    }
 
 print(f"--- STARTING SEARCH (WITH CITATION GENERATION) ---")
 
-try:
-    pager = Works().search(SEARCH_QUERY).filter(has_abstract=True)
-    results = []
-    count = 0
+# Rows are streamed straight to the CSV as pages arrive; only IDs and year counts stay in memory
+total_written = 0
+year_counts = Counter()
+seen_ids = set() # Papers matching several sub-queries are only kept once
+
+with open(args.out, "w", newline="", encoding="utf-8") as out_file:
+    writer = csv.DictWriter(out_file, fieldnames=FIELDNAMES)
+    writer.writeheader()
     
-    for page in pager.paginate(per_page=100):
-        for paper in page:
-            if count >= MAX_RESULTS: break
-            
-            abstract = reconstruct_abstract(paper.get('abstract_inverted_index'))
-            pdf_link = paper.get('open_access', {}).get('oa_url') if paper.get('open_access') else None
+    try:
+        queries = split_top_level_or(SEARCH_QUERY)
+        print(f"   Running {len(queries)} sub-queries concurrently...")
+        
+        # One queue per sub-query: they fetch concurrently, but are merged round-robin in query order,
+        # so every prong gets a fair share of MAX_RESULTS and the same query always keeps the same papers
+        page_queues = [queue.Queue(maxsize=QUEUED_PAGES) for _ in queries]
+        stop_event = threading.Event()
+        fetch_sem = threading.BoundedSemaphore(MAX_CONCURRENT_QUERIES)
+        
+        # Every sub-query needs its own thread, since the writer waits on each queue in turn
+        with ThreadPoolExecutor(max_workers=len(queries)) as executor:
+            futures = [executor.submit(fetch_query, q, pq, stop_event, fetch_sem) for q, pq in zip(queries, page_queues)]
             
-            full_citation = format_citation(paper)
+            # Take one page from each sub-query in turn; a sub-query drops out at its sentinel,
+            # leaving the others to backfill the cap
+            active = list(page_queues)
+            try:
+                while active and total_written < MAX_RESULTS:
+                    for page_queue in list(active):
+                        page = page_queue.get()
+                        if page is None:
+                            active.remove(page_queue)
+                            continue
+                        
+                        for paper in page:
+                            if total_written >= MAX_RESULTS: break
+                            if paper.get('id') in seen_ids: continue
+                            seen_ids.add(paper.get('id'))
+                            
+                            item = build_item(paper)
+                            writer.writerow(item)
+                            total_written += 1
+                            if item["Year"] is not None: year_counts[item["Year"]] += 1
+                        
+                        print(f"   Collected {total_written} papers...")
+                        if total_written >= MAX_RESULTS: break
+            finally:
+                # Producers may be blocked on a full queue, so empty each one up to its sentinel
+                stop_event.set()
+                for page_queue in active:
+                    for _ in iter(page_queue.get, None): pass
             
-            item = {
-                "ID": paper.get('id'),
-                "Generated_Citation": full_citation, 
-                "Title": paper.get('title'),
-                "Year": paper.get('publication_year'),
-                "DOI": paper.get('doi'),
-                "Abstract": abstract,
-                "PDF_Link": pdf_link,
-                "Source": "OpenAlex"
-            }
-            results.append(item)
-            count += 1
-        
-        print(f"   Collected {count} papers...")
-        if count >= MAX_RESULTS: break
-
-except Exception as e:
-    print(f"Error: {e}")
+            for future in futures: future.result() # Surfaces any sub-query error
+    
+    except Exception as e:
+        print(f"Error: {e}")
 
-df = pd.DataFrame(results)
-df.to_csv(args.out, index=False)
 print(f"Saved to '{args.out}'.")
 
 # ==========================================
 #        NEW: PROGRESS REPORT GENERATION
 # ==========================================
 print("--- GENERATING STEP 1 REPORT ---")
-year_counts = df['Year'].value_counts().to_dict() if not df.empty else {}
 
 report_data = [
     {"Metric": "Input Source", "Value": "OpenAlex API"},
     {"Metric": "Output File Generated", "Value": args.out},
     {"Metric": "Search Query Used", "Value": args.query},
-    {"Metric": "Total Papers Found & Extracted", "Value": len(df)},
+    {"Metric": "Total Papers Found & Extracted", "Value": total_written},
     {"Metric": "---", "Value": "---"},
     {"Metric": "YEAR BREAKDOWN", "Value": ""}
 ]
@@ -1,8 +1,15 @@
 import pandas as pd
+import numpy as np
 from google import genai
-import time
-import json
-import math
+from google.genai import types
+from pydantic import BaseModel
+import asyncio
+import orjson
+import os
+import shelve
+import hashlib
+import re
+import itertools
 import argparse
 
 # --- NEW: ARGPARSE SETUP ---
@@ -11,17 +18,37 @@ parser.add_argument("--in_csv", required=True)
 parser.add_argument("--out_csv", required=True)
 parser.add_argument("--report", required=True)
 parser.add_argument("--api", required=True)
+parser.add_argument("--cache_dir", default=None) # Defaults to the report's folder
+parser.add_argument("--stream_dir", default=None) # Hand accepted papers to a concurrently running Step 3
 args = parser.parse_args()
 
 # --- CONFIGURATION (UPDATED TO USE ARGS) ---
 INPUT_CSV = args.in_csv
 OUTPUT_CSV = args.out_csv
 BATCH_SIZE = 20
+MAX_CONCURRENT_BATCHES = 6 # Batches in flight at once (keep within your Gemini quota)
 API_KEY = args.api
 
+# Decision Cache: reruns skip any paper the AI has already screened
+CACHE_DIR = args.cache_dir or os.path.dirname(os.path.abspath(args.report))
+CACHE_PATH = os.path.join(CACHE_DIR, "gemini_cache.db")
+
+# Streaming: accepted papers are written here in small part files as soon as they are decided
+STREAM_DIR = args.stream_dir
+STREAM_DONE_MARKER = "_DONE"
+
 # Quality Settings
 MIN_ABSTRACT_LENGTH = 50
 REQUIRE_DOI = False
+BAD_PHRASES = ["no abstract", "abstract available", "see full text"]
+PLACEHOLDER_PATTERN = "|".join(map(re.escape, BAD_PHRASES))
+
+# Local Pre-Filter (Optional, needs: pip install sentence-transformers)
+# Describe your topic in a sentence or two. Abstracts scoring below the threshold are
+# rejected locally before they ever reach Gemini. Leave empty to disable.
+TARGET_DESCRIPTION = ""
+PREFILTER_MODEL = "all-MiniLM-L6-v2"
+PREFILTER_THRESHOLD = 0.2 # Cosine similarity (0 to 1)
 
 # --- NEW GENAI CLIENT SETUP ---
 client = genai.Client(api_key=API_KEY)
@@ -45,21 +72,26 @@ Format:
 ]
 """
 
-def pre_flight_check(paper):
-    abstract = str(paper.get('Abstract', ''))
-    if len(abstract) < MIN_ABSTRACT_LENGTH:
-        return False, "Abstract too short"
-    
-    bad_phrases = ["no abstract", "abstract available", "see full text"]
-    if any(phrase in abstract.lower() for phrase in bad_phrases):
-        return False, "Placeholder text"
+class Decision(BaseModel):
+    ID: int
+    Included: bool
+    Reason: str
 
-    if REQUIRE_DOI and pd.isna(paper.get('DOI')):
-        return False, "Missing DOI"
+# Gemini is constrained to this schema, so the reply is always a parseable JSON list
+SCREEN_CONFIG = types.GenerateContentConfig(
+    response_mime_type='application/json',
+    response_schema=list[Decision],
+)
 
-    return True, "Passed"
+def similarity_scores(texts):
+    """Scores each text against TARGET_DESCRIPTION (cosine similarity) with a small local embedding model."""
+    from sentence_transformers import SentenceTransformer # Only imported when the pre-filter is enabled
+    model = SentenceTransformer(PREFILTER_MODEL)
+    goal_emb = model.encode(TARGET_DESCRIPTION, normalize_embeddings=True)
+    embs = model.encode(texts, batch_size=64, convert_to_numpy=True, normalize_embeddings=True)
+    return embs @ goal_emb
 
-def screen_batch(papers_batch):
+async def screen_batch(sem, batch_num, total_batches, papers_batch):
     batch_text = ""
     for p in papers_batch:
         batch_text += f"--- PAPER ID: {p['ID']} ---\nTitle: {p['Title']}\nAbstract: {str(p['Abstract'])[:2000]}\n\n"
@@ -69,18 +101,22 @@ def screen_batch(papers_batch):
     # Try up to 3 times if Google is busy
     for attempt in range(3):
         try:
-            response = client.models.generate_content(
-                model='gemini-2.0-flash',
-                contents=full_prompt
-            )
-            clean_json = response.text.replace("```json", "").replace("```", "").strip()
-            return json.loads(clean_json)
+            async with sem:
+                print(f"   Batch {batch_num}/{total_batches}...")
+                # The SDK call is blocking, so it runs in a worker thread
+                response = await asyncio.to_thread(
+                    client.models.generate_content,
+                    model='gemini-2.0-flash',
+                    contents=full_prompt,
+                    config=SCREEN_CONFIG
+                )
+            return orjson.loads(response.text)
             
         except Exception as e:
             error_msg = str(e)
             if "429" in error_msg or "RESOURCE_EXHAUSTED" in error_msg:
                 print(f"   [API Busy] Google Rate Limit hit. Waiting 10 seconds before retry {attempt+1}/3...")
-                time.sleep(10) # Pause to let the API cool down
+                await asyncio.sleep(10) # Pause to let the API cool down (other batches keep running)
             else:
                 print(f"   Batch AI Error: {error_msg}")
                 return []
@@ -88,56 +124,135 @@ def screen_batch(papers_batch):
     print("   Failed after 3 attempts. Skipping batch.")
     return []
 
+async def screen_all(batches, on_batch_done):
+    """Screens every batch concurrently, at most MAX_CONCURRENT_BATCHES at a time."""
+    sem = asyncio.Semaphore(MAX_CONCURRENT_BATCHES)
+    
+    async def run(num, batch):
+        on_batch_done(await screen_batch(sem, num, len(batches), batch))
+    
+    await asyncio.gather(*(run(num, batch) for num, batch in enumerate(batches, start=1)))
+
+def cache_key(paper):
+    # The prompt is part of the key so editing the inclusion criteria invalidates old decisions
+    text = f"{SYSTEM_PROMPT}{paper['Title']}{paper['Abstract']}"
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+streamed_ids = set()
+part_numbers = itertools.count(1)
+
+def stream_accepted(decisions):
+    """Writes the newly accepted papers among decisions to STREAM_DIR as one part file (no-op without --stream_dir)."""
+    if not STREAM_DIR: return
+    accepted = {}
+    for decision in decisions:
+        temp_id = decision.get("ID")
+        if decision.get("Included") is True and temp_id in df.index and temp_id not in streamed_ids:
+            accepted[temp_id] = decision.get("Reason", "Unknown")
+    if not accepted: return
+    
+    streamed_ids.update(accepted)
+    part = df.loc[list(accepted)].copy() # Temp_ID doubles as the row label
+    part["Included"] = True
+    part["Rejection_Reason"] = list(accepted.values())
+    
+    part_path = os.path.join(STREAM_DIR, f"part_{next(part_numbers):05d}.csv")
+    part.to_csv(part_path + ".tmp", index=False)
+    os.replace(part_path + ".tmp", part_path) # Step 3 only ever sees complete files
+
 print("--- STARTING BATCH SCREENING ---")
+if STREAM_DIR: os.makedirs(STREAM_DIR, exist_ok=True)
 df = pd.read_csv(INPUT_CSV)
 df['Temp_ID'] = range(len(df))
 df["Included"] = False
-df["Rejection_Reason"] = ""
 
-valid_papers_for_ai = []
+# Phase 1: Pre-Flight (Every check runs column-wide; the first failing check names the reason)
+abstract = df['Abstract'].fillna('').astype(str).str.lower()
+rejections = np.select(
+    [
+        abstract.str.len() < MIN_ABSTRACT_LENGTH,
+        abstract.str.contains(PLACEHOLDER_PATTERN, regex=True, na=False),
+        df['DOI'].isna() & REQUIRE_DOI,
+    ],
+    ["Auto-Reject: Abstract too short", "Auto-Reject: Placeholder text", "Auto-Reject: Missing DOI"],
+    default=""
+)
+df["Rejection_Reason"] = rejections
+valid_papers_for_ai = df.loc[rejections == ""].to_dict('records')
 
-# Phase 1: Pre-Flight
-for index, row in df.iterrows():
-    p_dict = row.to_dict()
-    is_valid, reason = pre_flight_check(p_dict)
-    if is_valid:
-        valid_papers_for_ai.append(p_dict)
-    else:
-        df.at[index, "Included"] = False
-        df.at[index, "Rejection_Reason"] = f"Auto-Reject: {reason}"
+# Phase 1b: Local Similarity Pre-Filter
+if TARGET_DESCRIPTION.strip() and valid_papers_for_ai:
+    scores = similarity_scores([f"{p['Title']}. {p['Abstract']}" for p in valid_papers_for_ai])
+    passed = scores >= PREFILTER_THRESHOLD
+    
+    rejected = [(p['Temp_ID'], score) for p, score, ok in zip(valid_papers_for_ai, scores, passed) if not ok]
+    if rejected:
+        # Temp_ID doubles as the row label (it is a range over the freshly read CSV)
+        df.loc[[temp_id for temp_id, _ in rejected], "Rejection_Reason"] = [
+            f"Auto-Reject: Low similarity to target ({score:.2f})" for _, score in rejected
+        ]
+    valid_papers_for_ai = [p for p, ok in zip(valid_papers_for_ai, passed) if ok]
+    print(f"   Pre-filter rejected {len(rejected)} off-topic papers locally.")
 
 print(f"   Queued {len(valid_papers_for_ai)} papers for AI.")
 
 # Phase 2: AI Batching
 if valid_papers_for_ai:
     results_map = {}
-    total_batches = math.ceil(len(valid_papers_for_ai) / BATCH_SIZE)
+    os.makedirs(CACHE_DIR, exist_ok=True)
     
-    for i in range(0, len(valid_papers_for_ai), BATCH_SIZE):
-        batch = valid_papers_for_ai[i : i + BATCH_SIZE]
-        print(f"   Batch {(i // BATCH_SIZE) + 1}/{total_batches}...")
+    with shelve.open(CACHE_PATH) as cache:
+        key_by_id = {p['Temp_ID']: cache_key(p) for p in valid_papers_for_ai}
         
-        mini_batch = [{"ID": p['Temp_ID'], "Title": p['Title'], "Abstract": p['Abstract']} for p in batch]
+        uncached_papers = []
+        for p in valid_papers_for_ai:
+            cached = cache.get(key_by_id[p['Temp_ID']])
+            if cached is not None:
+                results_map[p['Temp_ID']] = {"ID": p['Temp_ID'], **cached}
+            else:
+                uncached_papers.append(p)
+        print(f"   Reused {len(results_map)} cached decisions.")
+        stream_accepted(list(results_map.values()))
+        
+        def record_decisions(batch_decisions):
+            # Saved as each batch finishes, so a crash partway keeps everything screened so far
+            for decision in batch_decisions:
+                results_map[decision.get("ID")] = decision
+                key = key_by_id.get(decision.get("ID"))
+                if key is not None:
+                    cache[key] = {"Included": decision.get("Included", False), "Reason": decision.get("Reason", "Unknown")}
+            cache.sync()
+            stream_accepted(batch_decisions)
         
-        batch_decisions = screen_batch(mini_batch)
+        batches = [
+            [{"ID": p['Temp_ID'], "Title": p['Title'], "Abstract": p['Abstract']} for p in uncached_papers[i : i + BATCH_SIZE]]
+            for i in range(0, len(uncached_papers), BATCH_SIZE)
+        ]
+        print(f"   Screening {len(batches)} batches ({MAX_CONCURRENT_BATCHES} at a time)...")
         
-        for decision in batch_decisions:
-            results_map[decision.get("ID")] = decision
-        time.sleep(1)
-
-    # Phase 3: Merge
-    for index, row in df.iterrows():
-        temp_id = row['Temp_ID']
-        if temp_id in results_map:
-            res = results_map[temp_id]
-            df.at[index, "Included"] = res.get("Included", False)
-            df.at[index, "Rejection_Reason"] = res.get("Reason", "Unknown")
+        if batches:
+            asyncio.run(screen_all(batches, record_decisions))
+
+    # Phase 3: Merge (Build whole columns, then assign once)
+    included_arr = np.zeros(len(df), dtype=bool)
+    reason_arr = df["Rejection_Reason"].to_numpy(dtype=object, copy=True)
+    for pos, temp_id in enumerate(df['Temp_ID'].tolist()):
+        res = results_map.get(temp_id)
+        if res is not None:
+            included_arr[pos] = res.get("Included", False) is True
+            reason_arr[pos] = res.get("Reason", "Unknown")
+    df["Included"] = included_arr
+    df["Rejection_Reason"] = reason_arr
 
 # Save
 filtered_df = df[df["Included"] == True]
 filtered_df.to_csv(OUTPUT_CSV, index=False)
 print(f"DONE. Included: {len(filtered_df)}")
 
+# Tell a following Step 3 that no more papers are coming
+if STREAM_DIR:
+    open(os.path.join(STREAM_DIR, STREAM_DONE_MARKER), "w").close()
+
 # ==========================================
 #        NEW: PROGRESS REPORT GENERATION
 # ==========================================
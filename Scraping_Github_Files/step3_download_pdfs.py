@@ -1,9 +1,14 @@
 import pandas as pd
-import requests
+import numpy as np
+import aiohttp
+import aiofiles
+import asyncio
 import os
 import time
-import re
 import argparse
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
 
 # --- NEW: ARGPARSE SETUP ---
 parser = argparse.ArgumentParser()
@@ -12,6 +17,7 @@ parser.add_argument("--out_csv", required=True)
 parser.add_argument("--report", required=True)
 parser.add_argument("--pdf_dir", required=True)
 parser.add_argument("--email", required=True)
+parser.add_argument("--follow", default=None) # Stream folder written by a concurrently running Step 2
 args = parser.parse_args()
 
 # --- CONFIGURATION (UPDATED TO USE ARGS) ---
@@ -20,129 +26,357 @@ OUTPUT_CSV = args.out_csv
 DOWNLOAD_FOLDER = args.pdf_dir
 EMAIL = args.email 
 
+# Concurrency: 8 downloads at once, max 4 per host (stays polite to publishers)
+MAX_CONCURRENT_DOWNLOADS = 8
+DOWNLOAD_TIMEOUT = 10 # Per connect and per read, not for the whole file, so large PDFs still finish
+CHUNK_SIZE = 1 << 15
+MAX_CONCURRENT_LOOKUPS = 10
+LOOKUP_TIMEOUT = 5
+OPENALEX_BATCH_SIZE = 50 # IDs per OpenAlex request (filter values are OR'ed with "|")
+HEADERS = {'User-Agent': 'Mozilla/5.0'}
+MIN_PDF_BYTES = 1024 # Anything smaller is treated as a broken/partial file
+
+# Streaming: how often to check for newly accepted papers from Step 2
+FOLLOW_POLL_SECONDS = 2
+STREAM_DONE_MARKER = "_DONE"
+
+# Retries: transient failures are retried with exponential backoff (0.5s, 1s, 2s)
+RETRY_STATUSES = {429, 502, 503, 504}
+MAX_RETRIES = 3
+BACKOFF_FACTOR = 0.5
+MAX_RETRY_AFTER = 60 # Longer Retry-After waits give up instead, since the caller holds a semaphore slot while sleeping
+
+# Hosts whose 429 said the credit allowance is used up. Retrying can't help, so they are skipped for the rest of the run.
+EXHAUSTED_HOSTS = set()
+
 if not os.path.exists(DOWNLOAD_FOLDER):
     os.makedirs(DOWNLOAD_FOLDER)
 
+# Filename cleanup table: newlines become spaces, characters Windows forbids are dropped
+_FILENAME_TABLE = str.maketrans('\n', ' ', '\\/*?:"<>|\r')
+
 def sanitize_filename(citation):
     if pd.isna(citation): return "Unknown_File"
-    clean = str(citation)
-    
-    # NEW: Force characters to standard ASCII English letters (fixes Unicode crashes)
-    clean = clean.encode('ascii', errors='ignore').decode('ascii')
+    # Force characters to standard ASCII English letters (fixes Unicode crashes), then clean in one pass
+    clean = str(citation).encode('ascii', errors='ignore').decode('ascii')
+    return clean.translate(_FILENAME_TABLE)[:200].strip()
+
+class CreditsExhausted(Exception):
+    """The host rejected the request because its rate-limit credits are used up (not a temporary throttle)."""
+
+def is_credit_exhausted(resp):
+    remaining = resp.headers.get('X-RateLimit-Remaining', '').strip()
+    required = resp.headers.get('X-RateLimit-Credits-Required', '').strip()
+    return remaining == '0' and required.isdigit() and int(required) > 0
+
+def retry_after_seconds(resp):
+    """Parses Retry-After as either delta-seconds or an HTTP date. Returns None if absent/invalid."""
+    value = resp.headers.get('Retry-After', '').strip()
+    if value.isdigit(): return float(value)
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+async def get_with_retry(session, url, **kwargs):
+    """
+    session.get() that retries dropped connections and RETRY_STATUSES responses.
+    Waits as long as the server's Retry-After asks (up to MAX_RETRY_AFTER), otherwise backs off exponentially.
+    Raises CreditsExhausted instead of retrying when a 429 means the allowance is gone.
+    """
+    host = urlsplit(url).hostname
+    if host in EXHAUSTED_HOSTS: raise CreditsExhausted(host)
     
-    # Original logic
-    clean = re.sub(r'[\\/*?:"<>|]', "", clean)
-    clean = clean.replace("\n", " ").replace("\r", "")
-    return clean[:200].strip()
+    for attempt in range(MAX_RETRIES + 1):
+        backoff = BACKOFF_FACTOR * (2 ** attempt)
+        try:
+            resp = await session.get(url, **kwargs)
+        except aiohttp.ClientConnectionError:
+            if attempt == MAX_RETRIES: raise
+            await asyncio.sleep(backoff)
+            continue
+        
+        if resp.status == 429 and is_credit_exhausted(resp):
+            resp.release()
+            EXHAUSTED_HOSTS.add(host)
+            print(f"   [Rate Limit] Credits exhausted for {host}. Skipping it for the rest of the run.")
+            raise CreditsExhausted(host)
+        
+        if resp.status not in RETRY_STATUSES or attempt == MAX_RETRIES:
+            return resp
+        
+        wait = retry_after_seconds(resp)
+        if wait is not None and wait > MAX_RETRY_AFTER:
+            return resp # Too long to hold the slot; the caller reports the status (e.g. "HTTP 429: Rate Limited")
+        
+        resp.release() # Hand the connection back to the pool before waiting
+        await asyncio.sleep(backoff if wait is None else wait)
+
+def short_openalex_id(work_id):
+    """'https://openalex.org/W123' -> 'W123'"""
+    return str(work_id).rstrip('/').rsplit('/', 1)[-1]
+
+async def fetch_openalex_batch(session, sem, work_ids):
+    """One OpenAlex request for up to OPENALEX_BATCH_SIZE works. Returns {work_id: pdf_url} for those with a direct PDF."""
+    params = {
+        "filter": "openalex_id:" + "|".join(work_ids),
+        "select": "id,best_oa_location",
+        "per-page": str(len(work_ids)),
+        "mailto": EMAIL,
+    }
+    links = {}
+    async with sem:
+        try:
+            timeout = aiohttp.ClientTimeout(total=LOOKUP_TIMEOUT)
+            async with await get_with_retry(session, "https://api.openalex.org/works", params=params, timeout=timeout) as resp:
+                if resp.status == 200:
+                    data = await resp.json()
+                    for work in data.get('results', []):
+                        url = (work.get('best_oa_location') or {}).get('pdf_url')
+                        if url: links[short_openalex_id(work.get('id'))] = url
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, CreditsExhausted):
+            pass # The whole batch keeps its landing-page links
+    return links
 
-def check_unpaywall(doi):
-    if pd.isna(doi) or not doi: return None
+async def scavenge_openalex(work_ids):
+    """Looks up direct PDF links for many OpenAlex IDs, OPENALEX_BATCH_SIZE per request, concurrently."""
+    batches = [work_ids[i:i + OPENALEX_BATCH_SIZE] for i in range(0, len(work_ids), OPENALEX_BATCH_SIZE)]
+    connector = aiohttp.TCPConnector(limit=MAX_CONCURRENT_LOOKUPS)
+    sem = asyncio.Semaphore(MAX_CONCURRENT_LOOKUPS)
+    found = {}
+    async with aiohttp.ClientSession(connector=connector) as session:
+        for links in await asyncio.gather(*(fetch_openalex_batch(session, sem, b) for b in batches)):
+            found.update(links)
+    return found
+
+async def fetch_unpaywall(session, sem, doi):
     url = f"https://api.unpaywall.org/v2/{doi}?email={EMAIL}"
-    try:
-        resp = requests.get(url, timeout=5)
-        if resp.status_code == 200:
-            data = resp.json()
-            best_loc = data.get('best_oa_location', {})
-            if best_loc: return best_loc.get('url_for_pdf')
-    except: pass
+    async with sem:
+        try:
+            timeout = aiohttp.ClientTimeout(total=LOOKUP_TIMEOUT)
+            async with await get_with_retry(session, url, timeout=timeout) as resp:
+                if resp.status == 200:
+                    data = await resp.json()
+                    best_loc = data.get('best_oa_location', {})
+                    if best_loc: return best_loc.get('url_for_pdf')
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, CreditsExhausted):
+            pass # No link found; the row falls through to the normal missing-link handling
     return None
 
+async def scavenge_unpaywall(dois):
+    """Looks up every DOI on Unpaywall concurrently, returning PDF links in the same order."""
+    connector = aiohttp.TCPConnector(limit=MAX_CONCURRENT_LOOKUPS)
+    sem = asyncio.Semaphore(MAX_CONCURRENT_LOOKUPS)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        return await asyncio.gather(*(fetch_unpaywall(session, sem, d) for d in dois))
+
 # --- UPGRADED: CATCHES SPECIFIC HTTP ERROR CODES ---
-def download_pdf(url, filename):
-    try:
-        headers = {'User-Agent': 'Mozilla/5.0'}
-        resp = requests.get(url, headers=headers, stream=True, timeout=10)
-        if resp.status_code == 200:
-            ctype = resp.headers.get('Content-Type', '').lower()
-            if 'pdf' in ctype or url.endswith('.pdf'):
-                with open(filename, 'wb') as f:
-                    for chunk in resp.iter_content(chunk_size=8192):
-                        f.write(chunk)
-                return True, "Success"
-            else:
-                return False, f"Wrong Content-Type (HTML/Login Page?): {ctype}"
-        elif resp.status_code in [401, 403]:
-            return False, f"HTTP {resp.status_code}: Paywall or Automation Blocked"
-        elif resp.status_code == 404:
-            return False, "HTTP 404: Dead Link"
-        else:
-            return False, f"HTTP Error {resp.status_code}"
-    except requests.exceptions.Timeout:
-        return False, "Server Timeout"
-    except Exception as e:
-        return False, f"Connection Error: {type(e).__name__}"
+async def download_pdf(session, sem, url, path):
+    async with sem:
+        try:
+            timeout = aiohttp.ClientTimeout(total=None, sock_connect=DOWNLOAD_TIMEOUT, sock_read=DOWNLOAD_TIMEOUT)
+            async with await get_with_retry(session, url, headers=HEADERS, timeout=timeout) as resp:
+                if resp.status == 200:
+                    ctype = resp.headers.get('Content-Type', '').lower()
+                    if 'pdf' in ctype or url.endswith('.pdf'):
+                        # Write to a side file first so an interrupted download never looks complete
+                        part_path = path + ".part"
+                        try:
+                            async with aiofiles.open(part_path, 'wb') as f:
+                                while True:
+                                    chunk = await resp.content.read(CHUNK_SIZE)
+                                    if not chunk: break
+                                    await f.write(chunk)
+                            os.replace(part_path, path)
+                        finally:
+                            # Only left behind if the download failed before it was moved into place
+                            if os.path.exists(part_path): os.remove(part_path)
+                        return True, "Success"
+                    else:
+                        return False, f"Wrong Content-Type (HTML/Login Page?): {ctype}"
+                elif resp.status in [401, 403]:
+                    return False, f"HTTP {resp.status}: Paywall or Automation Blocked"
+                elif resp.status == 404:
+                    return False, "HTTP 404: Dead Link"
+                elif resp.status == 429:
+                    return False, "HTTP 429: Rate Limited"
+                else:
+                    return False, f"HTTP Error {resp.status}"
+        except asyncio.TimeoutError:
+            return False, "Server Timeout"
+        except CreditsExhausted:
+            return False, "HTTP 429: Rate Limit Credits Exhausted"
+        except Exception as e:
+            return False, f"Connection Error: {type(e).__name__}"
 
-print("--- STARTING PRODUCTION DOWNLOAD ---")
-df = pd.read_csv(INPUT_CSV)
-df["Local_PDF_Path"] = "Not Downloaded"
-df["Download_Status"] = "Pending"
-df["Error_Reason"] = "" # New column to track exact failure cause
+def is_cached_pdf(path):
+    """True if a previous run already saved a real PDF here (big enough and starts with %PDF)."""
+    try:
+        if os.path.getsize(path) <= MIN_PDF_BYTES: return False
+        with open(path, 'rb') as f:
+            return f.read(4) == b'%PDF'
+    except OSError:
+        return False
 
-# Track which rows to keep
-valid_indices = []
+async def download_all(jobs):
+    """Downloads every (rows, url, path) job concurrently over one shared connection pool."""
+    connector = aiohttp.TCPConnector(limit=20, limit_per_host=4, ttl_dns_cache=300)
+    sem = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        tasks = [asyncio.ensure_future(download_pdf(session, sem, url, path)) for _, url, path in jobs]
+        return await asyncio.gather(*tasks, return_exceptions=True)
 
-for index, row in df.iterrows():
-    citation_key = row.get('Generated_Citation')
-    if pd.isna(citation_key): citation_key = row.get('Title', 'Untitled')
-    
-    pdf_url = row.get('PDF_Link')
-    doi = row.get('DOI')
+def process_papers(df):
+    """
+    Scavenges links for, filters, and downloads one set of papers.
+    Returns only the rows worth keeping, with the download columns filled in.
+    """
+    # 1. SCAVENGE MISSING LINKS (Unpaywall per DOI for rows without a link, OpenAlex in bulk for landing pages)
+    df["PDF_Link"] = df["PDF_Link"].astype(object)
     
-    # 1. SCAVENGE IF NEEDED
-    if pd.isna(pdf_url) or str(pdf_url) == "nan":
-        if pd.notna(doi):
-            print(f"   [Scavenging] Checking Unpaywall for DOI...")
-            found_link = check_unpaywall(doi)
-            if found_link:
-                pdf_url = found_link
-                df.at[index, "PDF_Link"] = found_link # Save retrieved link
+    # Step 1 already took open_access.oa_url from OpenAlex, so asking again only helps when
+    # that link is a landing page: best_oa_location.pdf_url may point at the PDF itself
+    landing_page = df["PDF_Link"].notna() & df["ID"].notna() & ~df["PDF_Link"].astype(str).str.lower().str.endswith(".pdf")
+    if landing_page.any():
+        work_ids = df.loc[landing_page, "ID"].map(short_openalex_id)
+        print(f"   [Scavenging] Checking OpenAlex for direct PDFs of {landing_page.sum()} landing pages ({OPENALEX_BATCH_SIZE} per request)...")
+        found = work_ids.map(asyncio.run(scavenge_openalex(work_ids.unique().tolist())))
+        upgraded = found.notna()
+        df.loc[found.index[upgraded], "PDF_Link"] = found[upgraded] # Rows without a direct PDF keep their landing page
     
-    # 2. FILTER: If we still have no link and no DOI, mark for deletion
-    if (pd.isna(pdf_url) or str(pdf_url) == "nan") and (pd.isna(doi) or str(doi) == "nan"):
-        print(f"   [Dropping] No Link/DOI for: {citation_key[:30]}...")
-        df.at[index, "Download_Status"] = "Dropped (No Access)"
-        df.at[index, "Error_Reason"] = "No Link or DOI Available"
-        continue # Skip download, will be filtered out later
-
-    valid_indices.append(index)
-
-    # 3. DOWNLOAD (If link exists)
-    if pdf_url and str(pdf_url) != "nan":
-        safe_name = sanitize_filename(citation_key) + ".pdf"
-        file_path = os.path.join(DOWNLOAD_FOLDER, safe_name)
-        
-        print(f"[{index+1}] Downloading: {safe_name[:40]}...")
-        
+    missing_link = df["PDF_Link"].isna() & df["DOI"].notna()
+    if missing_link.any():
+        print(f"   [Scavenging] Checking Unpaywall for {missing_link.sum()} DOIs...")
+        found_links = asyncio.run(scavenge_unpaywall(df.loc[missing_link, "DOI"].tolist()))
+        df.loc[missing_link, "PDF_Link"] = pd.Series(found_links, index=df.index[missing_link]) # Save retrieved links
+
+    # Results are collected per row position and written back as whole columns at the end
+    paths = ["Not Downloaded"] * len(df)
+    statuses = ["Pending"] * len(df)
+    reasons = [""] * len(df) # Tracks exact failure cause
+
+    # Track which rows to keep
+    keep = np.zeros(len(df), dtype=bool)
+    download_jobs = [] # (row positions, url, path); rows whose citations sanitize to the same file share one job
+    job_by_path = {}
+
+    for pos, row in enumerate(df.to_dict('records')):
+        citation_key = row.get('Generated_Citation')
+        if pd.isna(citation_key): citation_key = row.get('Title', 'Untitled')
+
+        pdf_url = row.get('PDF_Link')
+        doi = row.get('DOI')
+
+        # 2. FILTER: If we still have no link and no DOI, mark for deletion
+        if (pd.isna(pdf_url) or str(pdf_url) == "nan") and (pd.isna(doi) or str(doi) == "nan"):
+            print(f"   [Dropping] No Link/DOI for: {citation_key[:30]}...")
+            statuses[pos] = "Dropped (No Access)"
+            reasons[pos] = "No Link or DOI Available"
+            continue # Skip download, will be filtered out later
+
+        keep[pos] = True
+
+        # 3. QUEUE DOWNLOAD (If link exists)
+        if pdf_url and str(pdf_url) != "nan":
+            safe_name = sanitize_filename(citation_key) + ".pdf"
+            file_path = os.path.join(DOWNLOAD_FOLDER, safe_name)
+
+            # Skip the HTTP round-trip entirely if the file is already on disk
+            if is_cached_pdf(file_path):
+                print(f"[{pos+1}] Cached: {safe_name[:40]}...")
+                paths[pos] = file_path
+                statuses[pos] = "Success (Cached)"
+                continue
+
+            if file_path in job_by_path: # Same target file: one download, result shared
+                job_by_path[file_path][0].append(pos)
+                continue
+            print(f"[{pos+1}] Queued: {safe_name[:40]}...")
+            job_by_path[file_path] = ([pos], pdf_url, file_path)
+            download_jobs.append(job_by_path[file_path])
+        else:
+            statuses[pos] = "Link Only (No PDF URL)"
+            reasons[pos] = "URL Missing entirely"
+
+    # 4. DOWNLOAD ALL QUEUED FILES CONCURRENTLY
+    print(f"   Downloading {len(download_jobs)} PDFs ({MAX_CONCURRENT_DOWNLOADS} at a time)...")
+    results = asyncio.run(download_all(download_jobs)) if download_jobs else []
+
+    for (positions, pdf_url, file_path), result in zip(download_jobs, results):
         # Capture the success boolean AND the specific error reason
-        success, reason = download_pdf(pdf_url, file_path)
-        
-        if success:
-            df.at[index, "Local_PDF_Path"] = file_path
-            df.at[index, "Download_Status"] = "Success"
+        if isinstance(result, BaseException):
+            success, reason = False, f"Connection Error: {type(result).__name__}"
         else:
-            df.at[index, "Download_Status"] = "Failed (Link Exists)"
-            df.at[index, "Error_Reason"] = reason
-    else:
-        df.at[index, "Download_Status"] = "Link Only (No PDF URL)"
-        df.at[index, "Error_Reason"] = "URL Missing entirely"
-        
-    time.sleep(1)
+            success, reason = result
+
+        for pos in positions:
+            if success:
+                paths[pos] = file_path
+                statuses[pos] = "Success"
+            else:
+                statuses[pos] = "Failed (Link Exists)"
+                reasons[pos] = reason
+
+    # object dtype keeps these text columns even when the batch is empty
+    df["Local_PDF_Path"] = pd.Series(paths, index=df.index, dtype=object)
+    df["Download_Status"] = pd.Series(statuses, index=df.index, dtype=object)
+    df["Error_Reason"] = pd.Series(reasons, index=df.index, dtype=object)
+
+    # Only keep rows that are "Success", "Success (Cached)", "Failed (Link Exists)", or "Link Only"
+    # Drop rows that had absolutely nothing.
+    return df[keep].copy()
+
+def follow_stream(stream_dir):
+    """
+    Yields the accepted papers Step 2 writes into stream_dir, until its done marker appears.
+    Every part that is available at a poll is merged into one batch, so lookups and downloads
+    run over as many papers at once as possible (parts pile up while the previous batch downloads).
+    """
+    os.makedirs(stream_dir, exist_ok=True)
+    seen = set()
+    while True:
+        # Check the marker BEFORE listing, so every part written before it is still picked up
+        finished = os.path.exists(os.path.join(stream_dir, STREAM_DONE_MARKER))
+        parts = sorted(f for f in os.listdir(stream_dir) if f.endswith(".csv") and f not in seen)
+        if parts:
+            seen.update(parts)
+            yield pd.concat([pd.read_csv(os.path.join(stream_dir, name)) for name in parts], ignore_index=True)
+        if finished: return
+        if not parts: time.sleep(FOLLOW_POLL_SECONDS)
+
+print("--- STARTING PRODUCTION DOWNLOAD ---")
+
+# Either work through Step 2's stream as it grows, or the finished input file in one go
+if args.follow:
+    print(f"   Following accepted papers from '{args.follow}'...")
+    batches = follow_stream(args.follow)
+else:
+    batches = [pd.read_csv(INPUT_CSV)]
+
+total_in = 0
+kept_parts = []
+for batch_df in batches:
+    total_in += len(batch_df)
+    kept_parts.append(process_papers(batch_df))
 
 # --- CLEANUP & SAVE ---
-# Only keep rows that are "Success", "Failed (Link Exists)", or "Link Only"
-# Drop rows that had absolutely nothing.
-final_df = df.loc[valid_indices].copy()
+if not kept_parts: # Nothing was streamed; the (empty) input file still provides the columns
+    kept_parts.append(process_papers(pd.read_csv(INPUT_CSV)))
+final_df = pd.concat(kept_parts, ignore_index=True)
+if "Temp_ID" in final_df.columns: # Streamed batches arrive in completion order
+    final_df = final_df.sort_values("Temp_ID", ignore_index=True)
 final_df.to_csv(OUTPUT_CSV, index=False)
 
 print(f"Done. Processed {len(final_df)} valid papers.")
-print(f"Dropped {len(df) - len(final_df)} dead ends.")
+print(f"Dropped {total_in - len(final_df)} dead ends.")
 
 # ==========================================
 #        NEW: PROGRESS REPORT GENERATION
 # ==========================================
 print("--- GENERATING STEP 3 REPORT ---")
 stats = final_df["Download_Status"].value_counts().to_dict()
-failed_df = final_df[final_df["Download_Status"] != "Success"]
+succeeded = final_df["Download_Status"].isin(["Success", "Success (Cached)"])
+failed_df = final_df[~succeeded]
 
 # Tally up the specific error reasons
 error_counts = failed_df["Error_Reason"].value_counts().to_dict()
@@ -151,7 +385,8 @@ report_data = [
     {"File/Title": "Input File", "Status": args.in_csv, "Reason": "SUMMARY STATS"},
     {"File/Title": "Output File", "Status": args.out_csv, "Reason": ""},
     {"File/Title": "Total Attempted", "Status": len(final_df), "Reason": ""},
-    {"File/Title": "Successfully Downloaded", "Status": stats.get("Success", 0), "Reason": ""},
+    {"File/Title": "Successfully Downloaded", "Status": int(succeeded.sum()), "Reason": ""},
+    {"File/Title": "  (Reused From Disk)", "Status": stats.get("Success (Cached)", 0), "Reason": ""},
     {"File/Title": "Total Failed / Blocked", "Status": len(failed_df), "Reason": ""},
     {"File/Title": "---", "Status": "---", "Reason": "---"},
     {"File/Title": "ERROR BREAKDOWN", "Status": "COUNT", "Reason": ""}
@@ -1,5 +1,4 @@
 import pandas as pd
-import re
 import argparse
 
 # --- NEW: ARGPARSE SETUP ---
@@ -13,46 +12,35 @@ args = parser.parse_args()
 INPUT_CSV = args.in_csv
 OUTPUT_CSV = args.out_csv
 
-def extract_auth_from_citation(citation):
-    """
-    Extracts the author block from the citation string.
-    Expects format: "Author, A. (Year). Title..."
-    Returns: "Author, A."
-    """
-    if pd.isna(citation): return "Unknown"
-    
-    # Regex: Capture everything before the first "(Year)"
-    match = re.search(r'^(.*?)\s*\((\d{4}|n\.d\.)\)', str(citation))
-    if match:
-        return match.group(1).strip()
-    return "Unknown"
+# Author block of a citation: everything before the first "(Year)" or "(n.d.)"
+# "Author, A. (Year). Title..." -> "Author, A."
+AUTH_PATTERN = r'^(.*?)\s*\((?:\d{4}|n\.d\.)\)'
 
 print("--- STARTING FINAL EXPORT WITH SEPARATOR ---")
 
 try:
-    df = pd.read_csv(INPUT_CSV)
+    raw_df = pd.read_csv(INPUT_CSV) # Read once; Download_Status is needed below
     
     # 1. Define Columns
     # Map the raw data to your requested headers
-    df["Full Citation"] = df["Generated_Citation"]
-    df["Link"] = df["PDF_Link"]
-    df["Auth"] = df["Generated_Citation"].apply(extract_auth_from_citation)
-    df["Year"] = df["Year"]
-    df["Full Abstract"] = df["Abstract"]
-    df["Method"] = ""  # Empty for Step 5
-    
-    # Select only the columns we need
-    cols = ["Full Citation", "Link", "Auth", "Year", "Full Abstract", "Method"]
-    df = df[cols].copy()
+    citations = raw_df["Generated_Citation"]
+    df = pd.DataFrame({
+        "Full Citation": citations,
+        "Link": raw_df["PDF_Link"],
+        "Auth": citations.astype(str).str.extract(AUTH_PATTERN, expand=False).str.strip().fillna("Unknown"),
+        "Year": raw_df["Year"],
+        "Full Abstract": raw_df["Abstract"],
+        "Method": "" # Empty for Step 5
+    })
     
     # 2. Split into Two Groups
     # Group A: Successfully Downloaded (The ones Step 5 can analyze automatically)
-    raw_df = pd.read_csv(INPUT_CSV) # Need to read raw again to get Download_Status
-    df_downloaded = df[raw_df["Download_Status"] == "Success"].copy()
+    downloaded = raw_df["Download_Status"].isin(["Success", "Success (Cached)"])
+    df_downloaded = df[downloaded].copy()
     
     # Group B: Failed Download but has Link (The ones for manual review)
     # Logic: Status is NOT success, but PDF_Link is NOT empty
-    mask_links_only = (raw_df["Download_Status"] != "Success") & (raw_df["PDF_Link"].notna())
+    mask_links_only = (~downloaded) & (raw_df["PDF_Link"].notna())
     df_links_only = df[mask_links_only].copy()
     
     print(f"   Group A (Downloaded): {len(df_downloaded)} papers")
@@ -1,16 +1,23 @@
 import pandas as pd
 import os
-import time
-import json
-import shutil
+import asyncio
+import orjson
+import shelve
+import hashlib
+import re
+from functools import lru_cache
+from collections import Counter
+from importlib.util import find_spec
 import sys
+import queue
 import threading
 import argparse
-from concurrent.futures import ThreadPoolExecutor, as_completed
-# pip install thefuzz
-from thefuzz import fuzz 
+# pip install rapidfuzz
+from rapidfuzz import process, fuzz
 from google import genai
 from google.genai import types
+import httpx
+from pydantic import BaseModel
 
 # --- NEW: ARGPARSE SETUP ---
 parser = argparse.ArgumentParser()
@@ -19,6 +26,7 @@ parser.add_argument("--out_csv", required=True)
 parser.add_argument("--report", required=True)
 parser.add_argument("--pdf_dir", required=True)
 parser.add_argument("--api", required=True)
+parser.add_argument("--cache_dir", default=None) # Defaults to the report's folder
 args = parser.parse_args()
 
 # ==========================================
@@ -31,8 +39,33 @@ LOCAL_PDF_FOLDER = args.pdf_dir
 CITATION_COL = "Full Citation"                
 MODEL_NAME = "gemini-2.0-flash"
 
-# Parallelism: 10 papers at once (Safe for standard API limits)
-MAX_WORKERS = 10  
+# Progress: each finished row is appended to a JSON-lines log, and the whole table is snapshotted to
+# parquet every FLUSH_EVERY analyzed PDFs. The CSV deliverable is only written once, at the end
+# (the parquet copy stays next to it so a later resume doesn't have to re-parse the CSV).
+RESULTS_LOG = OUTPUT_CSV + ".results.jsonl"
+STATE_PARQUET = os.path.splitext(OUTPUT_CSV)[0] + ".parquet"
+FLUSH_EVERY = 50
+
+# Cache: analyses keyed by PDF content, so reruns never pay for the same paper twice
+CACHE_DIR = args.cache_dir or os.path.dirname(os.path.abspath(args.report))
+CACHE_PATH = os.path.join(CACHE_DIR, "analysis_cache.db")
+
+# Parallelism: papers run as asyncio tasks on one thread, since they mostly wait on Gemini
+MAX_CONCURRENT_PAPERS = 64
+# Processing checks: every 0.1s after something changes, backing off to every 0.5s while nothing does
+POLL_MIN_INTERVAL = 0.1
+POLL_MAX_INTERVAL = 0.5
+MATCH_THRESHOLD = 85 # Minimum citation-to-filename similarity (0-100) to treat a PDF as that paper's file
+MIN_SHARED_TOKENS = 2 # Only PDFs sharing this many words with a citation are fuzzy-scored against it
+MATCH_QUEUE_SIZE = 256 # Matches the matcher thread may run ahead of the analysis
+# Gemini calls in flight at once (set to your key's concurrent-request quota)
+MAX_CONCURRENT_REQUESTS = 10
+# Connection pool: large enough that uploads never queue for a socket. HTTP/2 is used when `h2` is installed.
+HTTP_POOL_SIZE = 256
+REQUEST_TIMEOUT_MS = 300_000 # Big PDF uploads can take minutes
+# PDFs smaller than this are sent inline with the request (no upload/processing/delete round trips).
+# Gemini caps an inline request at 20 MB, and base64 encoding inflates the bytes by a third.
+INLINE_PDF_LIMIT = 14 * 1024 * 1024
 
 ANALYSIS_PROMPT = """
 Analyze this PDF research paper. The goal is to [YOUR GOAL HERE].
@@ -44,6 +77,18 @@ Return the result as a valid JSON object with these keys:
 - "reason": "The explanation"
 """
 
+PROMPT_PART = types.Part(text=ANALYSIS_PROMPT) # Built once, reused by every request
+
+class Analysis(BaseModel):
+    methodology: str
+    reason: str
+
+# Gemini is constrained to this schema, so the reply is always a parseable JSON object
+ANALYSIS_CONFIG = types.GenerateContentConfig(
+    response_mime_type='application/json',
+    response_schema=Analysis,
+)
+
 # ==========================================
 #              SETUP & UTILS
 # ==========================================
@@ -52,166 +97,381 @@ if "PASTE" in GEMINI_API_KEY:
     print("❌ Error: Please update GEMINI_API_KEY inside the script!")
     sys.exit(1)
 
-client = genai.Client(api_key=GEMINI_API_KEY)
-csv_lock = threading.Lock() # Prevents file corruption when saving
+# One client (and one connection pool) shared by every paper task
+client = genai.Client(
+    api_key=GEMINI_API_KEY,
+    http_options=types.HttpOptions(
+        timeout=REQUEST_TIMEOUT_MS,
+        httpx_async_client=httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE),
+            http2=find_spec("h2") is not None,
+            timeout=REQUEST_TIMEOUT_MS / 1000,
+        ),
+    ),
+)
 
+_NORM_RE = re.compile(r'[^a-z0-9\s]')
+_FENCE = re.compile(r'^```(?:json)?\s*|\s*```$') # Markdown code fence around a JSON reply
+
+@lru_cache(maxsize=None)
 def normalize_text(text):
-    text = str(text).lower().replace('.pdf', '')
-    import re
-    text = re.sub(r'[^a-z0-9\s]', ' ', text)
-    return " ".join(text.split())
-
-def find_best_local_match(citation, local_files):
-    clean_cit = normalize_text(citation)
-    best_file = None
-    best_score = -1
-    for fname in local_files:
-        clean_file = normalize_text(fname)
-        score = fuzz.token_set_ratio(clean_cit, clean_file)
-        if score > best_score:
-            best_score = score
-            best_file = fname
-    return best_file, best_score
-
-def analyze_single_paper(row_idx, filename):
+    return " ".join(_NORM_RE.sub(' ', str(text).lower().replace('.pdf', '')).split())
+
+def match_local_files(citations, local_files):
     """
-    Uploads 1 PDF, Analyzes it, and returns the result immediately.
+    Finds the best-matching PDF for each citation.
+    An inverted index (word -> files) narrows each citation down to the files sharing
+    MIN_SHARED_TOKENS words with it, and only those are fuzzy-scored.
+    Yields (best_file, score) per citation, in order; (None, 0) when nothing reaches MATCH_THRESHOLD.
     """
-    original_path = os.path.join(LOCAL_PDF_FOLDER, filename)
+    norm_files = [normalize_text(f) for f in local_files]
+    file_tokens = [set(f.split()) for f in norm_files]
+    postings = {}
+    for j, tokens in enumerate(file_tokens):
+        for tok in tokens:
+            postings.setdefault(tok, []).append(j)
     
-    # Safe Temp File (Avoids Windows encoding issues)
-    temp_safe_name = f"temp_fast_{row_idx}.pdf"
-    temp_path = os.path.join(LOCAL_PDF_FOLDER, temp_safe_name)
+    for citation in citations:
+        clean_cit = normalize_text(citation)
+        shared = Counter(j for tok in set(clean_cit.split()) for j in postings.get(tok, ()))
+        # Files with fewer words than the minimum only need to share all of them.
+        # Kept in directory order so score ties go to the first file, whatever the hash seed
+        cands = sorted(j for j, n in shared.items() if n >= min(MIN_SHARED_TOKENS, len(file_tokens[j])))
+        match = process.extractOne(clean_cit, [norm_files[j] for j in cands], scorer=fuzz.token_set_ratio, score_cutoff=MATCH_THRESHOLD) if cands else None
+        if match is None:
+            yield None, 0
+        else:
+            _, score, k = match
+            yield local_files[cands[k]], score
+
+def pdf_cache_key(path):
+    """sha1 of the prompt + the PDF bytes (editing ANALYSIS_PROMPT invalidates old answers)."""
+    h = hashlib.sha1(ANALYSIS_PROMPT.encode('utf-8'))
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+class ProcessingPoller:
+    """Checks every upload that is still PROCESSING from one coroutine, instead of one sleep loop per file."""
+    def __init__(self):
+        self.waiting = {} # Gemini file name -> Future resolved with the processed file
+        self.wake = asyncio.Event()
     
-    try:
-        shutil.copy2(original_path, temp_path)
-        
-        # Upload using standard API (NOT Batch)
-        gemini_file = client.files.upload(file=temp_path)
-        
-        # Wait for processing
-        while gemini_file.state.name == "PROCESSING":
-            time.sleep(1)
-            gemini_file = client.files.get(name=gemini_file.name)
+    async def wait_until_processed(self, gemini_file):
+        if gemini_file.state.name != "PROCESSING": return gemini_file
+        done = asyncio.get_running_loop().create_future()
+        self.waiting[gemini_file.name] = done
+        self.wake.set()
+        return await done
+    
+    async def run(self):
+        interval = POLL_MIN_INTERVAL
+        while True:
+            # Sleep until the interval passes, or sooner if a new upload starts waiting
+            try:
+                await asyncio.wait_for(self.wake.wait(), timeout=interval)
+                interval = POLL_MIN_INTERVAL
+            except asyncio.TimeoutError:
+                interval = min(interval * 2, POLL_MAX_INTERVAL)
+            self.wake.clear()
+            if not self.waiting: continue
             
-        if gemini_file.state.name == "FAILED":
-            return row_idx, "Error", "File processing failed"
+            names = list(self.waiting)
+            files = await asyncio.gather(*(client.aio.files.get(name=n) for n in names), return_exceptions=True)
+            for name, f in zip(names, files):
+                if isinstance(f, Exception):
+                    self.waiting.pop(name).set_exception(f)
+                elif f.state.name != "PROCESSING":
+                    self.waiting.pop(name).set_result(f)
+                    interval = POLL_MIN_INTERVAL
+
+async def upload_pdf(api_sem, poller, filename):
+    """
+    Uploads 1 PDF and waits until Gemini has finished processing it.
+    """
+    # Upload using standard API (NOT Batch). The file is streamed from its own path;
+    # only the display name sent to Gemini needs to be plain ASCII (avoids Windows encoding issues)
+    display_name = filename.encode('ascii', errors='ignore').decode('ascii') or "paper.pdf"
+    upload_config = {'display_name': display_name, 'mime_type': 'application/pdf'}
+    async with api_sem:
+        with open(os.path.join(LOCAL_PDF_FOLDER, filename), 'rb') as f:
+            gemini_file = await client.aio.files.upload(file=f, config=upload_config)
+    
+    # Wait for processing (the shared poller checks all pending files together)
+    return await poller.wait_until_processed(gemini_file)
+
+async def delete_upload(upload):
+    """Cleanup Cloud File once no row needs it any more."""
+    try:
+        gemini_file = await upload
+        await client.aio.files.delete(name=gemini_file.name)
+    except Exception:
+        pass
+
+async def uploaded_part(upload):
+    """Waits for a (possibly shared) upload_pdf task and points a Part at the processed file."""
+    gemini_file = await upload
+    if gemini_file.state.name == "FAILED": raise RuntimeError("File processing failed")
+    return types.Part(file_data=types.FileData(mime_type=gemini_file.mime_type, file_uri=gemini_file.uri))
+
+async def inline_part(filename):
+    """Reads a small PDF into a Part that travels inside the generate_content request itself."""
+    with open(os.path.join(LOCAL_PDF_FOLDER, filename), 'rb') as f:
+        data = await asyncio.to_thread(f.read)
+    return types.Part.from_bytes(data=data, mime_type='application/pdf')
+
+async def analyze_single_paper(api_sem, filename, upload=None):
+    """
+    Analyzes 1 PDF and returns the result immediately.
+    `upload` is the upload_pdf task for a large file. Small files (upload=None) are only read
+    once a request slot is free, so at most MAX_CONCURRENT_REQUESTS of them sit in memory.
+    """
+    try:
+        if upload is not None: pdf_part = await uploaded_part(upload)
 
         # Generate Content
-        response = client.models.generate_content(
-            model=MODEL_NAME,
-            contents=[
-                types.Content(
-                    role="user",
-                    parts=[
-                        types.Part(text=ANALYSIS_PROMPT),
-                        types.Part(file_data=types.FileData(
-                            mime_type=gemini_file.mime_type,
-                            file_uri=gemini_file.uri
-                        ))
-                    ]
-                )
-            ]
-        )
-
-        # Cleanup Cloud File
-        try:
-            client.files.delete(name=gemini_file.name)
-        except:
-            pass
+        async with api_sem:
+            if upload is None: pdf_part = await inline_part(filename)
+            response = await client.aio.models.generate_content(
+                model=MODEL_NAME,
+                contents=[
+                    types.Content(
+                        role="user",
+                        parts=[
+                            PROMPT_PART,
+                            pdf_part
+                        ]
+                    )
+                ],
+                config=ANALYSIS_CONFIG
+            )
             
-        # Parse Result
-        text = response.text
-        clean_json = text.replace("```json", "").replace("```", "").strip()
-        data = json.loads(clean_json)
+        # Parse Result (the schema should rule out a code fence, but strip one in a single pass if it appears)
+        data = orjson.loads(_FENCE.sub('', response.text.strip()))
         
-        return row_idx, data.get("methodology", "Unknown"), data.get("reason", "")
+        return filename, data.get("methodology", "Unknown"), data.get("reason", "")
 
     except Exception as e:
-        # print(f"   [Row {row_idx}] Failed: {e}")
-        return row_idx, "Error", str(e)
-    finally:
-        # Cleanup Local Temp
-        if os.path.exists(temp_path):
+        # print(f"   [{filename}] Failed: {e}")
+        return filename, "Error", str(e)
+
+def save_checkpoint(df):
+    """Snapshots df to STATE_PARQUET (columnar, zstd-compressed) via an atomic replace."""
+    tmp_path = STATE_PARQUET + ".tmp"
+    df.to_parquet(tmp_path, compression='zstd')
+    os.replace(tmp_path, STATE_PARQUET)
+
+def save_output(df):
+    """Writes the final OUTPUT_CSV atomically, refreshes the parquet copy and clears the results log."""
+    tmp_path = OUTPUT_CSV + ".tmp"
+    df.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, OUTPUT_CSV)
+    save_checkpoint(df)
+    if os.path.exists(RESULTS_LOG): os.remove(RESULTS_LOG)
+
+def apply_logged_results(df):
+    """Folds rows that an interrupted run appended to RESULTS_LOG back into df. Returns how many were applied."""
+    if not os.path.exists(RESULTS_LOG): return 0
+    applied = 0
+    with open(RESULTS_LOG, 'rb') as f:
+        for line in f:
+            try:
+                result = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                continue # A line cut off by the interruption
+            df.at[result["row"], "Method"] = result["method"]
+            applied += 1
+    return applied
+
+async def analyze_all(filenames, on_done):
+    """
+    Analyzes every PDF yielded by the async iterator `filenames`, concurrently and as soon as it arrives.
+    A sliding window keeps up to MAX_CONCURRENT_PAPERS tasks in flight, starting a new one as each finishes,
+    so only the window (not one task per paper) exists at any time.
+    """
+    api_sem = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    poller = ProcessingPoller()
+    poll_task = asyncio.ensure_future(poller.run())
+    
+    def is_small(fname):
+        try:
+            return os.path.getsize(os.path.join(LOCAL_PDF_FOLDER, fname)) < INLINE_PDF_LIMIT
+        except OSError:
+            return False # Let the upload path report the missing file
+    
+    async def run(fname):
+        if is_small(fname):
+            result = await analyze_single_paper(api_sem, fname)
+        else:
+            upload = asyncio.ensure_future(upload_pdf(api_sem, poller, fname))
+            result = await analyze_single_paper(api_sem, fname, upload)
+            await delete_upload(upload)
+        on_done(*result)
+    
+    queued = filenames.__aiter__()
+    in_flight = set()
+    exhausted = False
+    while True:
+        while not exhausted and len(in_flight) < MAX_CONCURRENT_PAPERS:
             try:
-                os.remove(temp_path)
-            except:
-                pass
+                fname = await queued.__anext__()
+            except StopAsyncIteration:
+                exhausted = True
+                break
+            in_flight.add(asyncio.ensure_future(run(fname)))
+        if not in_flight: break
+        done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+        for t in done: t.result() # Re-raise anything unexpected instead of dropping it
+    poll_task.cancel()
 
 def run_fast_pipeline():
-    print(f"--- STARTING FAST LANE ANALYSIS ({MAX_WORKERS} threads) ---")
+    print(f"--- STARTING FAST LANE ANALYSIS ({MAX_CONCURRENT_PAPERS} papers at once) ---")
     
     # 1. Load Data
     try:
-        # We try to load the OUTPUT file first to resume progress
-        if os.path.exists(OUTPUT_CSV):
+        # We try to load the parquet state first, then the OUTPUT file, to resume progress
+        if os.path.exists(STATE_PARQUET):
+            df = pd.read_parquet(STATE_PARQUET)
+            print(f"Resuming from '{STATE_PARQUET}' ({len(df)} rows).")
+        elif os.path.exists(OUTPUT_CSV):
+            # Default parser: pyarrow's can't handle newlines inside quoted titles/abstracts
             df = pd.read_csv(OUTPUT_CSV)
             print(f"Resuming from '{OUTPUT_CSV}' ({len(df)} rows).")
         else:
             df = pd.read_csv(INPUT_CSV)
             print(f"Loaded fresh '{INPUT_CSV}' ({len(df)} rows).")
-            # Create the output file immediately
-            df.to_csv(OUTPUT_CSV, index=False)
             
     except Exception as e:
         print(f"Error reading CSV: {e}")
-        return
+        sys.exit(1) # Let the master halt instead of carrying on without an output file
+    if "Method" in df.columns: df["Method"] = df["Method"].astype(object) # An all-empty column loads as numbers
+    
+    # Pick up results the last run finished but never checkpointed
+    recovered = apply_logged_results(df)
+    if recovered:
+        save_checkpoint(df)
+        print(f"Recovered {recovered} unsaved results from '{RESULTS_LOG}'.")
+    if os.path.exists(RESULTS_LOG): os.remove(RESULTS_LOG)
 
     # 2. Prepare File List
     if not os.path.exists(LOCAL_PDF_FOLDER):
         print("Error: PDF folder not found.")
+        save_output(df)
         return
-    local_pdfs = [f for f in os.listdir(LOCAL_PDF_FOLDER) if f.lower().endswith('.pdf')]
+    with os.scandir(LOCAL_PDF_FOLDER) as entries:
+        local_pdfs = [e.name for e in entries if e.is_file() and e.name.lower().endswith('.pdf')]
     
-    tasks = []
     print("Matching files...")
     
-    for index, row in df.iterrows():
-        citation = str(row.get(CITATION_COL, ''))
-        link_status = str(row.get("Link", ""))
-        existing_method = str(row.get("Method", ""))
-        
-        # SKIP if already done (Resume capability)
-        if existing_method not in ["nan", "", "None", "Unknown"]:
-             continue
-
-        if not citation or "---" in citation or "Online Link Only" in link_status:
-            continue
-            
-        matched_file, score = find_best_local_match(citation, local_pdfs)
-        if score > 85:
-            tasks.append((index, matched_file))
-
-    if not tasks:
-        print("All papers are already analyzed! (Or none matched).")
-        return
-
-    print(f"Queueing {len(tasks)} papers for immediate analysis...")
-
-    # 3. Parallel Execution
+    blank = pd.Series("", index=df.index) # Stand-in for a column the CSV doesn't have
+    citations = df.get(CITATION_COL, blank).astype(str)
+    link_status = df.get("Link", blank).astype(str)
+    existing_method = df.get("Method", blank).astype(str)
+    
+    todo = (
+        existing_method.isin(["nan", "", "None", "Unknown"]) # SKIP if already done (Resume capability)
+        & citations.ne("")
+        & ~citations.str.contains("---", regex=False)
+        & ~link_status.str.contains("Online Link Only", regex=False)
+    )
+    candidates = list(zip(df.index[todo], citations[todo])) # (row index, citation) for rows still waiting on analysis
+    
+    # 3. Match And Analyze Side By Side
+    # A producer thread matches citations to PDFs and hands over each hit through match_queue,
+    # so Gemini calls start with the first match instead of after the last one
+    match_queue = queue.Queue(maxsize=MATCH_QUEUE_SIZE)
+    
+    def produce_matches():
+        try:
+            matches = match_local_files([c for _, c in candidates], local_pdfs)
+            for (row_idx, _), (fname, score) in zip(candidates, matches):
+                if score > MATCH_THRESHOLD:
+                    match_queue.put((row_idx, fname))
+        except Exception as e:
+            match_queue.put(e) # Re-raised by the consumer so a matching failure fails the run
+        else:
+            match_queue.put(None) # Tells the consumer that matching is finished
+    
+    threading.Thread(target=produce_matches, daemon=True).start()
+    
+    # Reuse Cached Analyses (the shelve is only touched from the event loop's thread)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    rows_by_file = {} # Rows that matched the same PDF (duplicate citations, reprints) share one analysis
+    finished = {} # filename -> (method, reason) once its analysis or cache hit is in
+    cached_files = set()
+    key_by_file = {}
+    matched_count = 0
     completed_count = 0
     
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        # Submit all tasks
-        future_to_row = {
-            executor.submit(analyze_single_paper, row_idx, fname): row_idx 
-            for row_idx, fname in tasks
-        }
+    with shelve.open(CACHE_PATH) as cache, open(RESULTS_LOG, 'ab') as results_fp:
         
-        # Process as they finish
-        for future in as_completed(future_to_row):
-            row_idx, method, reason = future.result()
-            
-            # Thread-safe CSV update
-            with csv_lock:
+        def apply_result(rows, method, reason):
+            # Only the event loop's thread touches df and the files, so no lock is needed
+            for row_idx in rows:
                 df.at[row_idx, "Method"] = method
                 # df.at[row_idx, "Reason"] = reason # Optional
                 
-                # Auto-save every row (Robustness!)
-                df.to_csv(OUTPUT_CSV, index=False)
+                # Append just these rows (Robustness!); the whole table is only checkpointed every FLUSH_EVERY PDFs
+                results_fp.write(orjson.dumps({"row": int(row_idx), "method": method, "reason": reason}) + b"\n")
+            results_fp.flush()
+        
+        async def new_files():
+            """Yields each PDF the first time a row matches it, unless the cache already has its answer."""
+            nonlocal matched_count
+            while True:
+                match = await asyncio.to_thread(match_queue.get)
+                if match is None: return
+                if isinstance(match, Exception): raise match
+                row_idx, fname = match
+                matched_count += 1
+                
+                if fname in finished: # Already answered: copy the result straight over
+                    rows_by_file[fname].append(row_idx)
+                    apply_result([row_idx], *finished[fname])
+                    continue
+                if fname in rows_by_file: # Still being analyzed: the result will be broadcast to this row too
+                    rows_by_file[fname].append(row_idx)
+                    continue
+                
+                rows_by_file[fname] = [row_idx]
+                key_by_file[fname] = await asyncio.to_thread(pdf_cache_key, os.path.join(LOCAL_PDF_FOLDER, fname))
+                cached = cache.get(key_by_file[fname])
+                if cached is None:
+                    yield fname
+                else:
+                    cached_files.add(fname)
+                    finished[fname] = (cached["methodology"], cached["reason"])
+                    apply_result(rows_by_file[fname], *finished[fname])
+        
+        # 4. Parallel Execution (results are processed as they finish)
+        def record_result(fname, method, reason):
+            nonlocal completed_count
+            finished[fname] = (method, reason)
+            rows = rows_by_file[fname]
+            apply_result(rows, method, reason)
+            if (completed_count + 1) % FLUSH_EVERY == 0:
+                save_checkpoint(df)
+            
+            # Errors are not cached so they get retried on the next run
+            if method != "Error":
+                cache[key_by_file[fname]] = {"methodology": method, "reason": reason}
+                cache.sync()
             
             completed_count += 1
-            print(f"✅ [{completed_count}/{len(tasks)}] Row {row_idx}: {method}")
+            print(f"✅ [{completed_count}] Row {', '.join(map(str, rows))}: {method}")
+        
+        print("Analyzing matches as they are found...")
+        asyncio.run(analyze_all(new_files(), record_result))
+    
+    if not matched_count:
+        print("All papers are already analyzed! (Or none matched).")
+        save_output(df)
+        return
+    
+    reused_count = sum(len(rows_by_file[f]) for f in cached_files)
+    if reused_count: print(f"Reused {reused_count} cached analyses.")
+    save_output(df) # Everything in the results log is now in OUTPUT_CSV
 
     print(f"\nSUCCESS! Processed {completed_count} papers.")
     print(f"Saved to '{OUTPUT_CSV}'.")
@@ -225,7 +485,8 @@ def run_fast_pipeline():
     report_data = [
         {"Metric": "Input File Used", "Value": args.in_csv},
         {"Metric": "Output File Generated", "Value": args.out_csv},
-        {"Metric": "Total Papers Evaluated by AI", "Value": len(tasks)},
+        {"Metric": "Total Papers Evaluated by AI", "Value": matched_count},
+        {"Metric": "  (Reused From Cache)", "Value": reused_count},
         {"Metric": "---", "Value": "---"},
         {"Metric": "METHODOLOGY DISTRIBUTION", "Value": ""}
     ]